@@ -15,14 +15,33 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import functools
+import shutil
 import subprocess
 
 
+@functools.lru_cache(maxsize=None)
+def _which(tool):
+    return shutil.which(tool) or tool
+
+
+def resolve_cmd(cmd):
+    # Passing an absolute path skips the PATH search on every call. It is
+    # also one of the things subprocess needs before it will use
+    # posix_spawn rather than fork+exec (callers should not pass
+    # preexec_fn); on Python >= 3.13 that works with close_fds=True too.
+    if '/' in cmd[0]:
+        return cmd
+    return [_which(cmd[0])] + list(cmd[1:])
+
+
 def run(cmd, check=True, **kw):
-    return subprocess.run(cmd, check=check, **kw)
+    return subprocess.run(resolve_cmd(cmd), check=check, **kw)
 
 
 def run_capture(cmd, **kw):
+    # subprocess.run() drains stdout and stderr together with a selector
+    # (via communicate()), so a chatty stream cannot stall the other.
     return run(
         cmd, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         **kw)
@@ -17,6 +17,8 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os
 import subprocess
 import sys
@@ -26,7 +28,7 @@ import yaml
 
 from livefs_edit import cli
 from livefs_edit.context import EditContext
-from livefs_edit.actions import ACTIONS
+from livefs_edit.actions import ACTIONS, SafeLoader
 
 
 HELP_TXT = """\
@@ -37,21 +39,85 @@ livefs-edit makes modifications to Ubuntu live ISOs and images.
 Actions include:
 """
 
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'livefs-edit', 'actions')
+CACHE_MAX_ENTRIES = 32
+
+
+def _prune_spec_cache():
+    # Keep only the most recently used entries (hits touch their file).
+    with os.scandir(CACHE_DIR) as it:
+        entries = [e for e in it if e.name.endswith('.json')]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in entries[CACHE_MAX_ENTRIES:]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _load_spec(path, debug=False):
+    # Parsed action specs are cached as JSON keyed by the sha256 of the
+    # YAML, so re-running the same spec in a build loop skips PyYAML.
+    with open(path, 'rb') as fp:
+        raw = fp.read()
+    cache_path = os.path.join(
+        CACHE_DIR, hashlib.sha256(raw).hexdigest() + '.json')
+    try:
+        with open(cache_path) as fp:
+            spec = json.load(fp)
+    except (OSError, ValueError):
+        pass
+    else:
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return spec
+    if debug:
+        print(f"loading action yaml with {SafeLoader.__name__}")
+    spec = yaml.load(raw, Loader=SafeLoader)
+    try:
+        data = json.dumps(spec)
+        # json.dumps quietly turns non-string keys into strings, so only
+        # cache a spec that comes back unchanged.
+        if json.loads(data) != spec:
+            return spec
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(data)
+        os.replace(tmp_path, cache_path)
+        _prune_spec_cache()
+    except (OSError, TypeError, ValueError):
+        # Dates and the like don't serialise at all (and the cache dir
+        # may not be writable); just don't cache then.
+        pass
+    return spec
+
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     if '--help' in argv or len(argv) < 3:
         print(HELP_TXT)
-        for action in sorted(ACTIONS.keys()):
-            print(f" * --{action.replace('_', '-')}")
+        for action in sorted(ACTIONS):
+            print(f" * --{action}")
         print()
         sys.exit(0)
 
     debug = False
-    if argv[0] == '--debug':
-        debug = True
-        argv.pop(0)
+    tmpfs = False
+    fast_squashfs = False
+    while argv[0] in ('--debug', '--tmpfs', '--fast-squashfs'):
+        opt = argv.pop(0)
+        if opt == '--debug':
+            debug = True
+        elif opt == '--tmpfs':
+            tmpfs = True
+        else:
+            fast_squashfs = True
 
     sourcepath = argv[0]
     destpath = argv[1]
@@ -63,13 +129,11 @@ def main(argv=None):
         destpath = destpath + '.new'
         inplace = True
 
-    ctxt = EditContext(sourcepath, debug=debug)
-
     if argv[2] == '--action-yaml':
         calls = []
-        with open(argv[3]) as fp:
-            spec = yaml.safe_load(fp)
-        print(spec)
+        spec = _load_spec(argv[3], debug=debug)
+        if debug:
+            print(spec)
         for action in spec:
             func = ACTIONS[action.pop('name')]
             calls.append((func, action))
@@ -80,6 +144,11 @@ def main(argv=None):
             print("parsing actions from command line failed:", e)
             sys.exit(1)
 
+    # Only create the context (which can mount a tmpfs) once the actions
+    # have been parsed, so a bad action list cannot leak anything.
+    ctxt = EditContext(
+        sourcepath, debug=debug, tmpfs=tmpfs, fast_squashfs=fast_squashfs)
+
     try:
         ctxt.mount_source()
 
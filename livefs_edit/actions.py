@@ -15,18 +15,26 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 import code
+import concurrent.futures
+import copy
 import enum
+import fcntl
 import functools
 import glob
-import gzip
 import os
 import pathlib
+import re
 import shlex
 import shutil
 import stat
 import subprocess
+import tempfile
 from typing import List
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
 
 ACTIONS = {}
@@ -59,17 +67,37 @@ def register_action(*, cache=False):
         if cache:
             impl = cached(impl)
 
-        ACTIONS[func.__name__.replace('_', '-')] = impl
+        ACTIONS[name] = impl
         return impl
     return decorator
 
 
+@functools.lru_cache(maxsize=64)
+def _load_yaml(path, mtime_ns, size):
+    with open(path) as fp:
+        return yaml.load(fp, Loader=SafeLoader)
+
+
+def load_yaml(path):
+    # Keyed on mtime and size so a file rewritten since it was last read
+    # gets parsed again. Callers are free to mutate what they get back.
+    st = os.stat(path)
+    return copy.deepcopy(_load_yaml(path, st.st_mtime_ns, st.st_size))
+
+
+def dump_yaml(data, fp):
+    yaml.dump(data, fp, Dumper=SafeDumper)
+
+
 class LayerfsLoc(enum.Enum):
     NONE = enum.auto()
     CMDLINE = enum.auto()
     INITRD = enum.auto()
 
 
+LAYERFS_PATH_RE = re.compile(r'^\s*LAYERFS_PATH=(.*?)\s*$', re.M)
+
+
 @cached
 def get_layerfs_path(ctxt):
     cmdline_val = get_cmdline_arg(ctxt, 'layerfs-path')
@@ -79,15 +107,13 @@ def get_layerfs_path(ctxt):
     if 'main' in os.listdir(initrd_path):
         initrd_path = initrd_path + '/main'
     layer_conf_path = f'{initrd_path}/conf/conf.d/default-layer.conf'
-    if os.path.exists(layer_conf_path):
+    try:
         with open(layer_conf_path) as fp:
-            for line in fp:
-                line = line.strip()
-                if line.startswith('LAYERFS_PATH='):
-                    return (
-                        line[len('LAYERFS_PATH='):],
-                        LayerfsLoc.INITRD,
-                        )
+            m = LAYERFS_PATH_RE.search(fp.read())
+    except FileNotFoundError:
+        m = None
+    if m:
+        return m.group(1), LayerfsLoc.INITRD
     return None, LayerfsLoc.NONE
 
 
@@ -108,11 +134,17 @@ def get_squash_names(ctxt):
         return get_all_squash_names(ctxt)
 
 
+SQUASHFS_RE = re.compile(r'([^.].*)\.squashfs\Z')
+
+
 @cached
 def get_all_squash_names(ctxt):
     basenames = []
-    for path in glob.glob(ctxt.p('old/iso/casper/*.squashfs')):
-        basenames.append(os.path.splitext(os.path.basename(path))[0])
+    with os.scandir(ctxt.p('old/iso/casper')) as it:
+        for entry in it:
+            m = SQUASHFS_RE.match(entry.name)
+            if m:
+                basenames.append(m.group(1))
     return basenames
 
 
@@ -121,7 +153,7 @@ def setup_rootfs(ctxt, target='rootfs'):
     target = ctxt.p(target)
 
     squash_names = get_squash_names(ctxt)
-    lowers = [ctxt.mount_squash(name) for name in squash_names]
+    lowers = ctxt.mount_squashes(squash_names)
     overlay = ctxt.add_overlay(lowers, target)
     ctxt.add_sys_mounts(target)
 
@@ -136,8 +168,7 @@ def setup_rootfs(ctxt, target='rootfs'):
     def _pre_repack():
         if overlay.unchanged():
             return
-        with ctxt.logged(f'creating new squashfs {new_squash_name}'):
-            ctxt.run(['mksquashfs', overlay.upperdir, new_squash])
+        ctxt.mksquashfs(overlay.upperdir, new_squash)
         if layerfs_loc == LayerfsLoc.CMDLINE:
             add_cmdline_arg(
                 ctxt,
@@ -162,6 +193,8 @@ def shell(ctxt, command=None):
     cmd = ['bash']
     if command is not None:
         cmd.extend(['-c', command])
+    forget_pool_debs(ctxt)
+    forget_apt_lists_fresh(ctxt)
     ctxt.run(cmd, cwd=ctxt.p())
 
 
@@ -181,24 +214,61 @@ def interpret_path(ctxt, path):
     return ctxt.p(path)
 
 
+FICLONE = 0x40049409
+
+
+def copy_file(src, dst):
+    # A reflink copy is a metadata-only operation on filesystems that
+    # support it; otherwise fall back to a real (sendfile) copy.
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    # Opening dst truncates it, so refuse before that as shutil.copy would.
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f'{src!r} and {dst!r} are the same file')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+    if cloned:
+        shutil.copymode(src, dst)
+    else:
+        shutil.copy(src, dst)
+
+
 @register_action()
 def cp(ctxt, source, dest):
+    forget_pool_debs(ctxt)
+    forget_apt_lists_fresh(ctxt)
     os.makedirs(interpret_path(ctxt, os.path.dirname(dest)), exist_ok=True)
-    shutil.copy(interpret_path(ctxt, source), interpret_path(ctxt, dest))
+    copy_file(interpret_path(ctxt, source), interpret_path(ctxt, dest))
 
 
 @register_action()
 def install_debs(ctxt, debs: List[str] = ()):
+    if not debs:
+        return
     rootfs = setup_rootfs(ctxt)
-    for i, deb in enumerate(debs):
-        deb_name = 'foo.deb'
-        rootfs_path = f'{rootfs}/{deb_name}'
-        with open(rootfs_path, 'x'):
-            pass
-        ctxt.run(['mount', '--bind', deb, rootfs_path])
-        ctxt.run(['chroot', rootfs, 'dpkg', '-i', deb_name])
-        ctxt.run(['umount', rootfs_path])
-        os.unlink(rootfs_path)
+    # Bind all the debs into the rootfs and install them with a single
+    # dpkg invocation so the database load and trigger processing only
+    # happen once.
+    deb_dir = 'livefs-edit-debs'
+    os.mkdir(f'{rootfs}/{deb_dir}')
+    deb_names = []
+    try:
+        for i, deb in enumerate(debs):
+            deb_name = f'/{deb_dir}/{i}.deb'
+            with open(f'{rootfs}{deb_name}', 'x'):
+                pass
+            ctxt.run(['mount', '--bind', deb, f'{rootfs}{deb_name}'])
+            deb_names.append(deb_name)
+        ctxt.run(['chroot', rootfs, 'dpkg', '-i'] + deb_names)
+    finally:
+        for deb_name in deb_names:
+            ctxt.run(['umount', f'{rootfs}{deb_name}'])
+        shutil.rmtree(f'{rootfs}/{deb_dir}')
 
 
 def rm_ro(func, path, _):
@@ -208,32 +278,45 @@ def rm_ro(func, path, _):
 
 
 def rm_f(path):
-    if os.path.lexists(path):
-        if os.path.isdir(path):
-            shutil.rmtree(path, onerror=rm_ro)
-        else:
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path, onerror=rm_ro)
+    else:
+        if not stat.S_ISLNK(st.st_mode):
             os.chmod(path, stat.S_IWRITE)
-            os.unlink(path)
+        os.unlink(path)
 
 
 @register_action()
 def rm(ctxt, path):
+    forget_pool_debs(ctxt)
+    forget_apt_lists_fresh(ctxt)
     rm_f(interpret_path(ctxt, path))
 
 
-def download_snap(ctxt, snap_name, channel):
-    dldir = ctxt.tmpdir()
+def download_snap(ctxt, snap_name, channel, dldir=None):
+    if dldir is None:
+        dldir = ctxt.tmpdir()
+    basename = f'{snap_name}_download'
     ctxt.run([
         'snap', 'download',
         '--channel=' + channel,
         '--target-directory=' + dldir,
-        '--basename=dl',
+        '--basename=' + basename,
         snap_name,
         ])
-    return os.path.join(dldir, 'dl.snap')
+    return os.path.join(dldir, basename + '.snap')
 
 
 def add_snap_files(snap_name, snap_file, seed_dir, channel, classic=False):
+    # Snaps downloaded straight into the seed just need renaming.
+    if os.path.dirname(snap_file) == f'{seed_dir}/snaps':
+        transfer = os.rename
+    else:
+        transfer = copy_file
     basename = f'{snap_name}_injected'
     info = {
         'name': snap_name,
@@ -243,18 +326,46 @@ def add_snap_files(snap_name, snap_file, seed_dir, channel, classic=False):
     if classic:
         info['classic'] = True
     target_snap = f'{seed_dir}/snaps/{basename}.snap'
-    shutil.copy(snap_file, target_snap)
+    transfer(snap_file, target_snap)
     assert_file = os.path.splitext(snap_file)[0] + '.assert'
     if os.path.exists(assert_file):
         assert_target = f'{seed_dir}/assertions/{basename}.assert'
-        shutil.copy(assert_file, assert_target)
+        transfer(assert_file, assert_target)
     else:
         info['unasserted'] = True
     return info
 
 
+def read_seed(ctxt, seed_dir):
+    # Injecting several snaps rewrites seed.yaml each time; remember what
+    # we wrote so it is not parsed again unless something else changed it.
+    seed_path = f'{seed_dir}/seed.yaml'
+    st = os.stat(seed_path)
+    key = (seed_path, st.st_mtime_ns, st.st_size)
+    cached = ctxt._cache.get('_seed')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    seed = load_yaml(seed_path)
+    ctxt._cache['_seed'] = (key, seed)
+    return seed
+
+
+def write_seed(ctxt, seed_dir, seed):
+    seed_path = f'{seed_dir}/seed.yaml'
+    with open(seed_path, "w") as fp:
+        dump_yaml(seed, fp)
+    st = os.stat(seed_path)
+    ctxt._cache['_seed'] = ((seed_path, st.st_mtime_ns, st.st_size), seed)
+
+
 @register_action()
 def inject_snap(ctxt, snap, channel="stable"):
+    _inject_snap(ctxt, snap, channel)
+
+
+def _inject_snap(ctxt, snap, channel, pending=()):
+    # pending names snaps the caller is about to inject itself, so they
+    # must not be downloaded here as a missing base.
     rootfs = setup_rootfs(ctxt)
     seed_dir = f'{rootfs}/var/lib/snapd/seed'
     snap_mount = ctxt.add_mount('squashfs', snap, ctxt.tmpdir())
@@ -265,8 +376,7 @@ def inject_snap(ctxt, snap, channel="stable"):
     if not os.path.isfile(snap_preseed_binary):
         raise FileNotFoundError('snap-preseed not found')
 
-    with open(snap_mount.p('meta/snap.yaml')) as fp:
-        snap_meta = yaml.safe_load(fp)
+    snap_meta = load_yaml(snap_mount.p('meta/snap.yaml'))
 
     if snap_meta.get('type') not in ['base', 'core']:
         base = snap_meta.get('base', 'core')
@@ -277,8 +387,7 @@ def inject_snap(ctxt, snap, channel="stable"):
 
     new_snaps = []
 
-    with open(f'{seed_dir}/seed.yaml') as fp:
-        old_seed = yaml.safe_load(fp)
+    old_seed = read_seed(ctxt, seed_dir)
     for old_snap in old_seed["snaps"]:
         if old_snap["name"] == snap_name:
             old_basename = os.path.splitext(old_snap['file'])[0]
@@ -293,13 +402,13 @@ def inject_snap(ctxt, snap, channel="stable"):
             snap_meta.get('confinement') == 'classic'))
 
     snap_names = {snap['name'] for snap in new_snaps}
-    if base is not None and base not in snap_names:
+    if base is not None and base not in snap_names and base not in pending:
         new_snaps.append(
             add_snap_files(
-                base, download_snap(ctxt, base, 'stable'), seed_dir, 'stable'))
+                base, download_snap(ctxt, base, 'stable', f'{seed_dir}/snaps'),
+                seed_dir, 'stable'))
 
-    with open(f'{seed_dir}/seed.yaml', "w") as fp:
-        yaml.dump({"snaps": new_snaps}, fp)
+    write_seed(ctxt, seed_dir, {"snaps": new_snaps})
 
     def _preseed_native():
         if '_preseed' in ctxt._cache:
@@ -326,21 +435,49 @@ def inject_snap(ctxt, snap, channel="stable"):
 
 @register_action()
 def add_snap_from_store(ctxt, snap_name, channel="stable"):
+    # Download straight into the seed so inject_snap can rename the snap
+    # into place rather than copying it.
+    seed_snaps = f'{setup_rootfs(ctxt)}/var/lib/snapd/seed/snaps'
     inject_snap(
-        ctxt, snap=download_snap(ctxt, snap_name, channel), channel=channel)
+        ctxt, snap=download_snap(ctxt, snap_name, channel, seed_snaps),
+        channel=channel)
+
+
+@register_action()
+def add_snaps_from_store(ctxt, snaps: List[str]):
+    # Each snap is "name" or "name=channel". The downloads are mostly
+    # waiting on the network, so run a few at once and then inject the
+    # snaps one by one as they all touch the seed.
+    seed_snaps = f'{setup_rootfs(ctxt)}/var/lib/snapd/seed/snaps'
+    snaps = [snap.partition('=')[::2] for snap in snaps]
 
+    def _download(snap):
+        snap_name, channel = snap
+        return download_snap(ctxt, snap_name, channel or 'stable', seed_snaps)
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        snap_files = list(ex.map(_download, snaps))
+    pending = {snap_name for snap_name, channel in snaps}
+    for (snap_name, channel), snap_file in zip(snaps, snap_files):
+        _inject_snap(ctxt, snap_file, channel or 'stable', pending)
+
+
+CMDLINE_CONFIG_FILES = [
+    'boot/grub/grub.cfg',    # grub, most arches
+    'isolinux/txt.cfg',      # isolinux, BIOS amd64/i386 <= focal
+    'boot/parmfile.ubuntu',  # s390x
+    ]
+
+
+@cached
 def cmdline_config_files(ctxt):
-    cfgs = [
-        'boot/grub/grub.cfg',    # grub, most arches
-        'isolinux/txt.cfg',      # isolinux, BIOS amd64/i386 <= focal
-        'boot/parmfile.ubuntu',  # s390x
-        ]
-    for path in cfgs:
+    paths = []
+    for path in CMDLINE_CONFIG_FILES:
         p = ctxt.p('new/iso/' + path)
         if not os.path.exists(p):
             continue
-        yield p
+        paths.append(p)
+    return paths
 
 
 @register_action()
@@ -348,32 +485,58 @@ def add_xorriso_args(ctx, xorriso_args: List[str] = ()):
     ctx._xorriso_extra_args.extend(xorriso_args)
 
 
+# Persistent args go at the end of the line, others just before the ---.
+CMDLINE_PERSIST_RE = re.compile(rb'^([^\n]*---[^\n]*?)[ \t\r\f\v]*$', re.M)
+CMDLINE_LIVE_RE = re.compile(rb'^([^\n]*?)[ \t]*---', re.M)
+
+
 @register_action()
 def add_cmdline_arg(ctxt, arg, persist: bool = True):
+    arg = arg.encode()
+    if persist:
+        regex = CMDLINE_PERSIST_RE
+        suffix = b' ' + arg
+    else:
+        regex = CMDLINE_LIVE_RE
+        suffix = b' ' + arg + b' ---'
     for path in cmdline_config_files(ctxt):
         with ctxt.logged(f'rewriting {path}'):
-            with open(path) as fp:
-                inputlines = list(fp)
-            with open(path, 'w') as outfp:
-                for line in inputlines:
-                    if '---' in line:
-                        if persist:
-                            line = line.rstrip() + ' ' + arg + '\n'
-                        else:
-                            before, after = line.split('---', 1)
-                            line = before.rstrip() + ' ' + arg + ' ---' + after
-                    outfp.write(line)
+            with open(path, 'rb') as fp:
+                content = fp.read()
+            content = regex.sub(lambda m: m.group(1) + suffix, content)
+            with open(path, 'wb') as outfp:
+                outfp.write(content)
+        ctxt._cache.get('_cmdline_args', {}).pop(path, None)
+
+
+def parse_cmdline_args(path):
+    args = {}
+    with open(path) as fp:
+        for line in fp:
+            if '---' in line:
+                # Without quotes or escapes shlex would just split on
+                # whitespace, so only pay for it when it matters.
+                if any(c in line for c in '"\'\\'):
+                    words = shlex.split(line)
+                else:
+                    words = line.split()
+                for word in words:
+                    if '=' in word:
+                        k, v = word.split('=', 1)
+                        args.setdefault(k, v)
+    return args
 
 
 def get_cmdline_arg(ctxt, key):
+    parsed = ctxt._cache.setdefault('_cmdline_args', {})
     for path in cmdline_config_files(ctxt):
-        with open(path) as fp:
-            for line in fp:
-                if '---' in line:
-                    words = shlex.split(line)
-                    for word in words:
-                        if word.startswith(key + '='):
-                            return word[len(key) + 1:]
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if path not in parsed or parsed[path][0] != stamp:
+            parsed[path] = (stamp, parse_cmdline_args(path))
+        args = parsed[path][1]
+        if key in args:
+            return args[key]
 
 
 @register_action()
@@ -387,29 +550,29 @@ def add_autoinstall_config(ctxt, autoinstall_config):
     CC_PREFIX = '#cloud-config\n'
 
     rootfs = setup_rootfs(ctxt)
-    is_cc = False
+    user_data = os.path.join(rootfs, seed_dir, 'user-data')
     with open(autoinstall_config) as fp:
-        first_line = fp.readline()
-        if first_line == CC_PREFIX:
-            is_cc = True
-            first_line = ''
-        config = yaml.safe_load(first_line + fp.read())
-    if not is_cc:
-        config = {'autoinstall': config}
-    with open(os.path.join(rootfs, seed_dir, 'user-data'), 'w') as fp:
-        fp.write(CC_PREFIX)
-        yaml.dump(config, fp)
+        is_cc = fp.readline() == CC_PREFIX
+    if is_cc:
+        # Already cloud-config, so it can be used as is.
+        shutil.copyfile(autoinstall_config, user_data)
+    else:
+        config = {'autoinstall': load_yaml(autoinstall_config)}
+        with open(user_data, 'w') as fp:
+            fp.write(CC_PREFIX)
+            dump_yaml(config, fp)
     add_cmdline_arg(ctxt, arg='autoinstall', persist=False)
 
 
-@register_action()
-def resign_pool(ctxt, dist=None):
-    if dist is None:
-        dist = ctxt.get_suite()
+SIGNING_KEY_EMAIL = 'noone@nowhere.invalid'
 
+
+@cached
+def signing_gpghome(ctxt):
+    # Generate the one-time signing key once per run; resigning the pool
+    # again (say, after a second add-debs-to-pool) reuses it.
     gpgconf = ctxt.tmpfile()
     gpghome = ctxt.tmpdir()
-    email = 'noone@nowhere.invalid'
     with open(gpgconf, 'x') as c:
         c.write(f"""\
 %no-protection
@@ -417,20 +580,29 @@ Key-Type: eddsa
 Key-Curve: Ed25519
 Key-Usage: sign
 Name-Real: Ubuntu Custom ISO One-Time Signing Key
-Name-Email: {email}
+Name-Email: {SIGNING_KEY_EMAIL}
 Expire-Date: 0
 """)
-    gpgconfp = open(gpgconf)
-    ctxt.run(
-        ['gpg', '--home', gpghome, '--gen-key', '--batch'],
-        stdin=gpgconfp)
+    with open(gpgconf) as gpgconfp:
+        ctxt.run(
+            ['gpg', '--home', gpghome, '--batch', '--gen-key'],
+            stdin=gpgconfp)
+    return gpghome
+
+
+@register_action()
+def resign_pool(ctxt, dist=None):
+    if dist is None:
+        dist = ctxt.get_suite()
 
+    gpghome = signing_gpghome(ctxt)
+    # The gpg calls share the agent the first one starts in gpghome;
+    # --batch keeps them from looking for a tty or pinentry.
+    gpg = ['gpg', '--home', gpghome, '--batch']
     release = ctxt.p(f'new/iso/dists/{dist}/Release')
 
-    ctxt.run([
-        'gpg',
-        '--home', gpghome,
-        '--local-user', email,
+    ctxt.run(gpg + [
+        '--local-user', SIGNING_KEY_EMAIL,
         '--detach-sign', '--armor', release
     ])
     os.rename(release + '.asc', release + '.gpg')
@@ -438,31 +610,61 @@ Expire-Date: 0
     new_fs = ctxt.edit_squashfs(get_squash_names(ctxt)[0])
     key_path = f'{new_fs}/etc/apt/trusted.gpg.d/custom-iso-key.gpg'
     with open(key_path, 'w') as new_key:
-        ctxt.run(['gpg', '--home', gpghome, '--export'], stdout=new_key)
+        ctxt.run(gpg + ['--export'], stdout=new_key)
+    # gpg starts the agent again on demand if the pool is resigned later.
+    ctxt.run(
+        ['gpgconf', '--homedir', gpghome, '--kill', 'gpg-agent'],
+        check=False)
+
+
+# A Release field: "Key: value" plus any indented continuation lines.
+RELEASE_FIELD_RE = re.compile(r'^([^\s:][^:\n]*):.*\n(?:[ \t].*\n)*', re.M)
+
+
+def merge_release(old, new):
+    # Replace the fields of old that new also has, keeping everything
+    # else (and the order of the fields) as it was.
+    new_fields = {
+        m.group(1): m.group(0) for m in RELEASE_FIELD_RE.finditer(new)
+        }
+    return RELEASE_FIELD_RE.sub(
+        lambda m: new_fields.get(m.group(1), m.group(0)), old)
 
 
 @register_action()
 def add_debs_to_pool(ctxt, debs: List[str] = ()):
-    from debian import deb822
     pool = ctxt.p('new/iso/pool/main')
-    for deb in debs:
-        shutil.copy(deb, pool)
+    if debs:
+        # The copies are independent and I/O bound, so overlap them.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(16, len(debs))) as ex:
+            list(ex.map(lambda deb: copy_file(deb, pool), debs))
+    if '_pool_debs' in ctxt._cache:
+        ctxt._cache['_pool_debs'].update(os.path.basename(deb) for deb in debs)
     dist = ctxt.get_suite()
     arch = ctxt.get_arch()
     packages = ctxt.p(f'new/iso/dists/{dist}/main/binary-{arch}/Packages')
-    cp = ctxt.run(
-        [
-            'apt-ftparchive', '--md5=off', '--sha1=off',
-            'packages', 'pool/main',
-        ],
-        cwd=ctxt.p('new/iso'), stdout=subprocess.PIPE)
-    with open(packages, 'wb') as new_packages:
-        new_packages.write(cp.stdout)
-    with gzip.open(packages + '.gz', 'wb') as new_packages:
-        new_packages.write(cp.stdout)
+    ftparchive_cmd = [
+        'apt-ftparchive', '--md5=off', '--sha1=off',
+        'packages', 'pool/main',
+        ]
+    with open(packages + '.gz', 'wb') as new_packages:
+        ftparchive = add_to_pipeline(
+            None, ftparchive_cmd, cwd=ctxt.p('new/iso'))
+        tee = add_to_pipeline(ftparchive, ['tee', packages])
+        compress = add_to_pipeline(
+            tee, gzip_cmd() + ['-9'], stdout=new_packages)
+        compress.communicate()
+    for cmd, proc in [
+            (ftparchive_cmd, ftparchive),
+            (['tee'], tee),
+            (gzip_cmd(), compress),
+            ]:
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
     release = ctxt.p(f'new/iso/dists/{dist}/Release')
     with open(release) as o:
-        old = deb822.Deb822(o)
+        old = o.read()
     for p in release, release + '.gpg':
         rm_f(p)
     cp = ctxt.run(
@@ -470,16 +672,12 @@ def add_debs_to_pool(ctxt, debs: List[str] = ()):
             'apt-ftparchive', '--md5=off', '--sha1=off', '--sha512=off',
             'release', f'dists/{dist}',
         ],
-        cwd=ctxt.p('new/iso'), stdout=subprocess.PIPE)
+        cwd=ctxt.p('new/iso'), encoding='utf-8', stdout=subprocess.PIPE)
     # The uncompressed Packages file has to be around when
     # apt-ftparchive release is ctxt.run, but it can be deleted now.
     os.unlink(packages)
-    new = deb822.Deb822(cp.stdout)
-    for k in old:
-        if k in new:
-            old[k] = new[k]
-    with open(release, 'wb') as new_release:
-        old.dump(new_release)
+    with open(release, 'w') as new_release:
+        new_release.write(merge_release(old, cp.stdout))
 
     resign_pool(ctxt, dist=dist)
 
@@ -494,35 +692,56 @@ def cache_for_dir(ctxt, dir):
     apt_pkg.config["APT::Architecture"] = ctxt.get_arch()
     apt_pkg.config["APT::Architectures"] = ctxt.get_arch()
     apt_pkg.init_system()
+    ctxt._cache['_apt_config_dir'] = dir
     return Cache()
 
 
-def download_missing_pool_debs(ctxt, cache):
-    tdir = ctxt.tmpdir()
-    pool_debs = set()
-    for dirpath, dirnames, filenames in os.walk(ctxt.p('new/iso/pool')):
-        for fname in filenames:
-            if fname.endswith('.deb'):
-                pool_debs.add(fname)
-    debs = []
-    for p in cache.get_changes():
-        fname = os.path.basename(p.candidate.filename)
-        if fname not in pool_debs:
-            debs.append(p.candidate.fetch_binary(tdir))
-    return debs
+def iter_pool_debs(root):
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.deb'):
+                    yield entry.name
 
 
-@register_action()
-def add_packages_to_pool(ctxt, packages: List[str]):
+def apt_lists_fresh(ctxt, dir):
+    if os.environ.get('LIVEFS_EDIT_SKIP_APT_UPDATE'):
+        return True
+    return dir in ctxt._cache.get('_apt_updated', set())
+
+
+def mark_apt_lists_fresh(ctxt, dir, fresh=True):
+    updated = ctxt._cache.setdefault('_apt_updated', set())
+    if fresh:
+        updated.add(dir)
+    else:
+        updated.discard(dir)
+
+
+def forget_apt_lists_fresh(ctxt):
+    # For actions that may have changed the apt sources behind our back.
+    ctxt._cache.pop('_apt_updated', None)
+
+
+def update_apt_lists(ctxt, cache, dir):
     from apt.progress.text import AcquireProgress
-    fs = ctxt.mount_squash(get_squash_names(ctxt)[0])
-    overlay = ctxt.add_overlay(fs, ctxt.tmpdir())
-    cache = cache_for_dir(ctxt, overlay.p())
+    if apt_lists_fresh(ctxt, dir):
+        ctxt.log(f'apt lists in {dir} already up to date')
+        return
     with ctxt.logged(
             '** updating apt lists... **',
             '** updating apt lists done **'):
         cache.update(AcquireProgress())
-    cache.open()
+    mark_apt_lists_fresh(ctxt, dir)
+
+
+def stage_packages_in_pool(ctxt, cache, packages):
+    # Mark everything first so the dependencies of all the packages are
+    # resolved together and the missing debs are fetched and added to
+    # the pool (and the pool resigned) once.
     for p in packages:
         with ctxt.logged(f'marking {p} for installation'):
             if "=" in p:
@@ -536,6 +755,62 @@ def add_packages_to_pool(ctxt, packages: List[str]):
     add_debs_to_pool(ctxt, debs=debs)
 
 
+def get_pool_debs(ctxt):
+    # add_debs_to_pool keeps this up to date; actions that can change the
+    # pool behind our back (shell, cp, ...) call forget_pool_debs.
+    if '_pool_debs' not in ctxt._cache:
+        ctxt._cache['_pool_debs'] = set(
+            iter_pool_debs(ctxt.p('new/iso/pool')))
+    return ctxt._cache['_pool_debs']
+
+
+def forget_pool_debs(ctxt):
+    ctxt._cache.pop('_pool_debs', None)
+
+
+def download_missing_pool_debs(ctxt, cache):
+    import apt_pkg
+    from apt.progress.text import AcquireProgress
+    tdir = ctxt.tmpdir()
+    pool_debs = get_pool_debs(ctxt)
+    # Queue all the downloads on one Acquire so apt can fetch them in
+    # parallel rather than one fetch_binary() at a time.
+    acq = apt_pkg.Acquire(AcquireProgress())
+    items = []
+    for p in cache.get_changes():
+        version = p.candidate
+        fname = os.path.basename(version.filename)
+        if fname not in pool_debs:
+            items.append(apt_pkg.AcquireFile(
+                acq, version.uri, f'SHA256:{version.sha256}', version.size,
+                fname, destfile=os.path.join(tdir, fname)))
+    if not items:
+        return []
+    acq.run()
+    for item in items:
+        if item.status != item.STAT_DONE:
+            raise Exception(
+                f"failed to fetch {item.destfile}: {item.error_text}")
+    return [item.destfile for item in items]
+
+
+@register_action()
+def add_packages_to_pool(ctxt, packages: List[str]):
+    # Reuse the cache from an earlier call as long as nothing has pointed
+    # the (global) apt config somewhere else in the meantime.
+    dir, cache = ctxt._cache.get('_pool_apt_cache', (None, None))
+    if cache is not None and ctxt._cache.get('_apt_config_dir') == dir:
+        cache.clear()
+    else:
+        fs = ctxt.mount_squash(get_squash_names(ctxt)[0])
+        dir = ctxt.add_overlay(fs, ctxt.tmpdir()).p()
+        cache = cache_for_dir(ctxt, dir)
+        update_apt_lists(ctxt, cache, dir)
+        cache.open()
+        ctxt._cache['_pool_apt_cache'] = (dir, cache)
+    stage_packages_in_pool(ctxt, cache, packages)
+
+
 def add_to_pipeline(prev_proc, cmds, env=None, **kw):
     if env is not None:
         base_env = os.environ.copy()
@@ -553,16 +828,42 @@ def add_to_pipeline(prev_proc, cmds, env=None, **kw):
     return proc
 
 
+def gzip_cmd():
+    # pigz produces gzip-compatible output using all cores.
+    if shutil.which('pigz'):
+        return ['pigz', '-n']
+    return ['gzip', '-n']
+
+
+def initrd_file_list(dir):
+    # The same list 'find . | LC_ALL=C sort' would produce.
+    paths = [b'.']
+    todo = [b'.']
+    while todo:
+        reldir = todo.pop()
+        with os.scandir(os.path.join(os.fsencode(dir), reldir)) as it:
+            for entry in it:
+                path = reldir + b'/' + entry.name
+                paths.append(path)
+                if entry.is_dir(follow_symlinks=False):
+                    todo.append(path)
+    paths.sort()
+    return b''.join(path + b'\n' for path in paths)
+
+
 def pack_for_initrd(dir, compress, outfile):
-    find = add_to_pipeline(None, ['find', '.'], cwd=dir)
-    sort = add_to_pipeline(find, ['sort'], env={'LC_ALL': 'C'})
-    cpio = add_to_pipeline(
-        sort, ['cpio', '-R', '0:0', '-o', '-H', 'newc'], cwd=dir)
+    cpio_cmd = ['cpio', '-R', '0:0', '-o', '-H', 'newc']
     if compress:
-        compress = add_to_pipeline(cpio, ['gzip'], stdout=outfile)
+        cpio = subprocess.Popen(
+            cpio_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=dir)
+        last = add_to_pipeline(cpio, gzip_cmd(), stdout=outfile)
     else:
-        compress = add_to_pipeline(cpio, ['cat'], stdout=outfile)
-    compress.communicate()
+        cpio = last = subprocess.Popen(
+            cpio_cmd, stdin=subprocess.PIPE, stdout=outfile, cwd=dir)
+    cpio.stdin.write(initrd_file_list(dir))
+    cpio.stdin.close()
+    cpio.wait()
+    last.communicate()
 
 
 @register_action(cache=True)
@@ -583,12 +884,25 @@ def unpack_initrd(ctxt, target='new/initrd'):
         def _pre_repack_multi():
             if overlay.unchanged():
                 return
+            def _pack(dir):
+                part = tempfile.TemporaryFile(dir=ctxt.p('.tmp'))
+                pack_for_initrd(f'{target}/{dir}', dir == "main", part)
+                part.seek(0)
+                return part
+
             with ctxt.logged(f'repacking initrd to {initrd_path} ...', 'done'):
+                # Pack the segments concurrently (the small early ones
+                # are done long before main has been compressed) and
+                # then concatenate them in order.
+                dirs = sorted(os.listdir(target))
+                for dir in dirs:
+                    ctxt.log(f'packing {dir}')
+                with concurrent.futures.ThreadPoolExecutor() as pool:
+                    parts = list(pool.map(_pack, dirs))
                 with open(ctxt.p(f'new/iso/{initrd_path}'), 'wb') as out:
-                    for dir in sorted(os.listdir(target)):
-                        with ctxt.logged(f'packing {dir}'):
-                            pack_for_initrd(
-                                f'{target}/{dir}', dir == "main", out)
+                    for part in parts:
+                        with part:
+                            shutil.copyfileobj(part, out)
 
         ctxt.add_pre_repack_hook(_pre_repack_multi)
     else:
@@ -607,7 +921,9 @@ def unpack_initrd(ctxt, target='new/initrd'):
 @register_action()
 def install_packages(ctxt, packages: List[str]):
     base = ctxt.edit_squashfs(get_squash_names(ctxt)[0])
-    ctxt.run(['chroot', base, 'apt-get', 'update'])
+    if not apt_lists_fresh(ctxt, base):
+        ctxt.run(['chroot', base, 'apt-get', 'update'])
+        mark_apt_lists_fresh(ctxt, base)
     env = os.environ.copy()
     env['DEBIAN_FRONTEND'] = 'noninteractive'
     env['LANG'] = 'C.UTF-8'
@@ -618,6 +934,7 @@ def install_packages(ctxt, packages: List[str]):
 def add_apt_repository(ctxt, repo):
     base = ctxt.edit_squashfs(get_squash_names(ctxt)[0])
     ctxt.run(['chroot', base, 'add-apt-repository', '-y', repo])
+    mark_apt_lists_fresh(ctxt, base, False)
 
 
 @register_action()
@@ -629,11 +946,7 @@ def replace_kernel(ctxt, flavor):
 
     # Update apt lists in the base layer.
     cache = cache_for_dir(ctxt, base)
-    from apt.progress.text import AcquireProgress
-    with ctxt.logged(
-            '** updating apt lists... **',
-            '** updating apt lists done **'):
-        cache.update(AcquireProgress())
+    update_apt_lists(ctxt, cache, base)
 
     if layerfs_path:
         # Find layers below the one that adds the kernel.
@@ -642,15 +955,14 @@ def replace_kernel(ctxt, flavor):
             squash_mount = ctxt.mount_squash(squash_name)
             modules_dir = squash_mount.p('usr/lib/modules')
             if os.path.exists(modules_dir):
-                if os.listdir(modules_dir) != []:
-                    break
+                with os.scandir(modules_dir) as it:
+                    if next(it, None) is not None:
+                        break
             below_kernel.append(squash_mount)
         else:
             raise Exception("cannot find layer that includes kernel")
     else:
-        below_kernel = [base] + [
-            ctxt.mount_squash(squash) for squash in squash_names[1:]
-            ]
+        below_kernel = [base] + ctxt.mount_squashes(squash_names[1:])
 
     # Create a new overlay to install kernel in.  In a layered ISO this will be
     # a new layer, in an older one we pull the kernel, initrd, and modules out
@@ -679,11 +991,7 @@ echo 'LazyUnmount=yes' >> /run/systemd/system/usr-lib-modules.mount.d/lazy.conf
 
     new_kernel_layer.write(
         'etc/initramfs-tools/scripts/init-bottom/live-server',
-        script)
-    os.chmod(
-        new_kernel_layer.p(
-            'etc/initramfs-tools/scripts/init-bottom/live-server'),
-        0o755)
+        script, mode=0o755)
     new_kernel_layer.write(
         'etc/initramfs-tools/conf.d/casperize.conf',
         'export CASPER_GENERATE_UUID=1\n')
@@ -694,9 +1002,7 @@ echo 'LazyUnmount=yes' >> /run/systemd/system/usr-lib-modules.mount.d/lazy.conf
 
     # Add any missing packages to the pool.
     cache = cache_for_dir(ctxt, new_kernel_layer.p())
-    cache[meta_pkg].mark_install()
-    debs = download_missing_pool_debs(ctxt, cache)
-    add_debs_to_pool(ctxt, debs=debs)
+    stage_packages_in_pool(ctxt, cache, [meta_pkg])
 
     # Set up new layer to get packages from pool (the changes to the
     # apt config and status will just be deleted from the layer later)
@@ -725,46 +1031,45 @@ echo 'LazyUnmount=yes' >> /run/systemd/system/usr-lib-modules.mount.d/lazy.conf
     [old_kernel] = glob.glob(ctxt.p('old/iso/casper/vmlinu?'))
     [kernel] = glob.glob(new_kernel_layer.p('boot/vmlinu?-*'))
     [initrd] = glob.glob(new_kernel_layer.p('boot/initrd.img-*'))
-    ctxt.run([
-        'mv', kernel,
-        ctxt.p('new/iso/casper/' + os.path.basename(old_kernel))])
-    ctxt.run(['mv', initrd, ctxt.p('new/iso/casper/initrd')])
+    # These are all moves between different overlays, so shutil.move
+    # ends up copying, but without a process per file.
+    shutil.move(
+        kernel, ctxt.p('new/iso/casper/' + os.path.basename(old_kernel)))
+    shutil.move(initrd, ctxt.p('new/iso/casper/initrd'))
 
     # Copy the uuid out of the new initrd.
     initrd_dir = ctxt.tmpdir()
     ctxt.run(['unmkinitramfs', ctxt.p('new/iso/casper/initrd'), initrd_dir])
     if 'main' in os.listdir(initrd_dir):
         initrd_dir = initrd_dir + '/main'
-    ctxt.run([
-        'mv',
+    shutil.move(
         f'{initrd_dir}/conf/uuid.conf',
-        ctxt.p('new/iso/.disk/casper-uuid-custom'),
-        ])
+        ctxt.p('new/iso/.disk/casper-uuid-custom'))
 
     if layerfs_path is not None:
         new_squash_name = ctxt.p(f'new/iso/casper/{squash_name}.squashfs')
 
         def _repack():
             # Remove the changes to the apt config and status.
-            ctxt.run(['rm', '-rf', f'{new_kernel_layer.upperdir}/var/lib/apt'])
-            ctxt.run(['rm', '-rf', f'{new_kernel_layer.upperdir}/etc/apt'])
-            ctxt.run(['rm', new_squash_name])
+            rm_f(f'{new_kernel_layer.upperdir}/var/lib/apt')
+            rm_f(f'{new_kernel_layer.upperdir}/etc/apt')
+            os.unlink(new_squash_name)
             # Build the new squashfs!
-            ctxt.run(['mksquashfs', new_kernel_layer.upperdir, new_squash_name])
+            ctxt.mksquashfs(new_kernel_layer.upperdir, new_squash_name)
 
         ctxt.add_pre_repack_hook(_repack)
     else:
-        ctxt.run([
-            'mksquashfs',
+        ctxt.mksquashfs(
             new_kernel_layer.p('lib/modules'),
-            ctxt.p('new/iso/casper/extras/modules.squashfs-custom'),
-            ])
+            ctxt.p('new/iso/casper/extras/modules.squashfs-custom'))
 
 
 @register_action()
 def python(ctxt, cmd=None):
     ns = globals().copy()
     ns['ctxt'] = ctxt
+    forget_pool_debs(ctxt)
+    forget_apt_lists_fresh(ctxt)
     if cmd:
         exec(cmd, ns, ns)
     else:
@@ -774,8 +1079,8 @@ def python(ctxt, cmd=None):
 @register_action()
 def mount_all_squashfses(ctxt):
     casper_dir = pathlib.Path(ctxt.p('new/iso/casper'))
-    for squash in casper_dir.glob('*.squashfs'):
-        ctxt.mount_squash(squash.stem)
+    ctxt.mount_squashes(
+        [squash.stem for squash in casper_dir.glob('*.squashfs')])
 
 
 @register_action()
@@ -784,5 +1089,5 @@ def mount_all_layers(ctxt, target='mounts'):
 
     for squash in casper_dir.glob('*.squashfs'):
         squash_names = get_layer_part_names(squash.stem)
-        lowers = [ctxt.mount_squash(name) for name in squash_names]
+        lowers = ctxt.mount_squashes(squash_names)
         ctxt.add_overlay(lowers, ctxt.p(f'{target}/{squash.stem}'))
@@ -15,15 +15,19 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import functools
 import inspect
 import typing
 
 
+TRUE_VALUES = frozenset({"on", "yes", "true"})
+
+
 def _conv(ann, v):
     if ann is inspect._empty:
         return v
     if ann is bool:
-        return v.lower() in ["on", "yes", "true"]
+        return v.lower() in TRUE_VALUES
     return v
 
 
@@ -31,16 +35,21 @@ class ArgException(Exception):
     pass
 
 
-def args_for_func(func, raw_args):
+@functools.lru_cache(maxsize=None)
+def _params_for_func(func):
+    # Action signatures never change, so only inspect each one once.
     sig = inspect.Signature.from_callable(func)
-    sig = sig.replace(parameters=list(sig.parameters.values())[1:])
-    params = sig.parameters
-    param_list = list(params.values())
-    kw = {}
+    param_list = list(sig.parameters.values())[1:]
     if param_list and param_list[-1].annotation == typing.List[str]:
         last_arg_name = param_list[-1].name
     else:
         last_arg_name = None
+    return param_list, last_arg_name
+
+
+def args_for_func(func, raw_args):
+    param_list, last_arg_name = _params_for_func(func)
+    kw = {}
     for i, a in enumerate(raw_args):
         if i >= len(param_list):
             if last_arg_name is None:
@@ -15,14 +15,28 @@
 # along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import contextlib
+import filecmp
 import glob
+import itertools
 import json
 import os
 import shlex
 import shutil
+import stat
 import subprocess
 import tempfile
+import time
+
+from livefs_edit import run
+
+
+SYS_MOUNTS = [
+    ('devtmpfs',   'dev'),
+    ('devpts',     'dev/pts'),
+    ('proc',       'proc'),
+    ]
 
 
 class _MountBase:
@@ -33,8 +47,15 @@ class _MountBase:
                 raise Exception('no absolute paths here please')
         return os.path.join(self.mountpoint, *args)
 
-    def write(self, path, content):
-        with open(self.p(path), 'w') as fp:
+    def write(self, path, content, *, mode=None):
+        if mode is None:
+            with open(self.p(path), 'w') as fp:
+                fp.write(content)
+            return
+        fd = os.open(self.p(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, 'w') as fp:
+            # The mode passed to os.open is filtered by the umask.
+            os.fchmod(fd, mode)
             fp.write(content)
 
 
@@ -51,24 +72,60 @@ class OverlayMountpoint(_MountBase):
         self.mountpoint = mountpoint
 
     def unchanged(self):
-        return os.listdir(self.upperdir) == []
+        # Stop at the first entry rather than listing the whole upperdir.
+        with os.scandir(self.upperdir) as it:
+            return next(it, None) is None
+
+    def changed_paths(self):
+        # Paths (relative to the mountpoint) that have been created or
+        # modified in the overlay. Whiteouts -- deletions -- are skipped.
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            with os.scandir(os.path.join(self.upperdir, rel)) as it:
+                for entry in it:
+                    path = os.path.join(rel, entry.name)
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                        continue
+                    yield path
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(path)
 
 
 class EditContext:
 
-    def __init__(self, source_path, *, debug=False):
+    def __init__(self, source_path, *, debug=False, tmpfs=False,
+                 fast_squashfs=False):
         self.source_path = source_path
         self.debug = debug
+        self.fast_squashfs = fast_squashfs
         self._source_overlay = None
         self.dir = tempfile.mkdtemp()
-        os.mkdir(self.p('.tmp'))
         self._cache = {}
+        self._tmpdir_ids = itertools.count()
+        self._umask = os.umask(0o022)
+        os.umask(self._umask)
         self._indent = ''
         self._pre_repack_hooks = []
         self._loops = []
         self._mounts = []
         self._squash_mounts = {}
+        self._edited_squashes = {}
+        self._squash_compression = None
+        self._arch = None
+        self._suite = None
+        self._squash_jobs = None
+        self._overlay_volatile = None
         self._xorriso_extra_args = []
+        self.tmpfs = tmpfs
+        if tmpfs:
+            # A fresh tmpfs is 1777; keep mkdtemp's 0700.
+            self.add_mount('tmpfs', 'tmpfs', self.dir, options='mode=0700')
+        os.mkdir(self.p('.tmp'))
+        # Keep .tmp open so tmpdir() can mkdir relative to it rather than
+        # resolving the whole path each time.
+        self._tmp_fd = os.open(self.p('.tmp'), os.O_PATH | os.O_DIRECTORY)
 
     def run(self, cmd, check=True, **kw):
         if self.debug:
@@ -79,7 +136,7 @@ class EditContext:
                 msg.append(arg)
             msg = ' '.join(msg)
             self.log(f"running with check={check}, kw={kw}\n{self._indent}    {msg}")
-        cp = subprocess.run(cmd, check=check, **kw)
+        cp = run(cmd, check=check, **kw)
         if self.debug:
             msg = f"exit code {cp.returncode}"
             if cp.stdout is not None:
@@ -109,9 +166,13 @@ class EditContext:
             self.log(done_msg)
 
     def tmpdir(self):
-        d = tempfile.mkdtemp(dir=self.p('.tmp'))
-        os.chmod(d, 0o755)
-        return d
+        # Only this method creates names like this in .tmp, so a counter
+        # is enough to make them unique and one mkdir does the job.
+        name = f'd{next(self._tmpdir_ids)}'
+        os.mkdir(name, 0o755, dir_fd=self._tmp_fd)
+        if self._umask & 0o755:
+            os.chmod(name, 0o755, dir_fd=self._tmp_fd)
+        return self.p('.tmp', name)
 
     def tmpfile(self):
         return tempfile.mktemp(dir=self.p('.tmp'))
@@ -126,10 +187,31 @@ class EditContext:
         cp = self.run_capture(['losetup', '--show', '--find', '--partscan', file])
         dev = cp.stdout.strip()
         self._loops.append(dev)
-        self.run(['udevadm', 'settle'])
+        self._wait_for_partitions(dev)
         self.log(f'set up loop device {dev} backing {file}')
         return dev
 
+    def _wait_for_partitions(self, dev):
+        # The kernel has registered the partitions in sysfs by the time
+        # losetup returns; just wait for their device nodes to show up
+        # rather than for the whole udev queue to drain.
+        name = os.path.basename(dev)
+        try:
+            with os.scandir(f'/sys/block/{name}') as it:
+                parts = [
+                    f'/dev/{entry.name}' for entry in it
+                    if entry.name.startswith(name)
+                    ]
+        except OSError:
+            parts = None
+        if parts is not None:
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                if all(os.path.exists(part) for part in parts):
+                    return
+                time.sleep(0.01)
+        self.run(['udevadm', 'settle'])
+
     def add_mount(self, typ, src, mountpoint, *, options=None):
         cmd = ['mount']
         if typ is not None:
@@ -137,12 +219,26 @@ class EditContext:
         cmd.append(src)
         if options:
             cmd.extend(['-o', options])
+        created = False
         if mountpoint is None:
             mountpoint = self.tmpdir()
+            created = True
+        else:
+            try:
+                os.makedirs(mountpoint)
+            except FileExistsError:
+                pass
+            else:
+                created = True
         cmd.append(mountpoint)
-        if not os.path.isdir(mountpoint):
-            os.makedirs(mountpoint)
-        self.run_capture(cmd)
+        try:
+            self.run_capture(cmd)
+        except subprocess.CalledProcessError:
+            # Don't leave empty mountpoints behind (find_livefs probes
+            # can fail a few times per run).
+            if created:
+                os.rmdir(mountpoint)
+            raise
         self._mounts.append(mountpoint)
         return Mountpoint(device=src, mountpoint=mountpoint)
 
@@ -151,18 +247,34 @@ class EditContext:
         self.run(['umount', mountpoint])
 
     def get_sysfs_mounts(self):
-        cp = self.run_capture(
-            ['findmnt', '--submounts', '/sys', '--json', '--list'])
-        return json.loads(cp.stdout)['filesystems']
+        # The host's /sys mounts do not change during a run.
+        if '_sysfs_mounts' not in self._cache:
+            cp = self.run_capture(
+                ['findmnt', '--submounts', '/sys', '--json', '--list'])
+            self._cache['_sysfs_mounts'] = json.loads(
+                cp.stdout)['filesystems']
+        return self._cache['_sysfs_mounts']
+
+    def get_sys_skel(self):
+        # devtmpfs, devpts and proc are the same in every chroot, so
+        # mount them once and bind mount them into each one.
+        if '_sys_skel' not in self._cache:
+            skel = {}
+            for typ, relpath in SYS_MOUNTS:
+                skel[relpath] = self.add_mount(
+                    typ, typ, self.p('.sys', typ)).p()
+                # Otherwise, with / shared (as under systemd), each bind
+                # joins the skel's peer group and unmounting one chroot's
+                # copy propagates to all the others.
+                self.run(['mount', '--make-rprivate', skel[relpath]])
+            self._cache['_sys_skel'] = skel
+        return self._cache['_sys_skel']
 
     def add_sys_mounts(self, mountpoint):
         mnts = []
-        for typ, relpath in [
-                ('devtmpfs',   'dev'),
-                ('devpts',     'dev/pts'),
-                ('proc',       'proc'),
-                ]:
-            mnts.append(self.add_mount(typ, typ, f'{mountpoint}/{relpath}'))
+        for relpath, src in self.get_sys_skel().items():
+            mnts.append(self.add_mount(
+                None, src, f'{mountpoint}/{relpath}', options='bind'))
         ro_targets = []
         for fs in self.get_sysfs_mounts():
             relpath = fs['target'].lstrip('/')
@@ -178,13 +290,20 @@ class EditContext:
         for ro_target in ro_targets:
             self.run(['mount', '-o', 'remount,ro', ro_target])
         resolv_conf = f'{mountpoint}/etc/resolv.conf'
-        os.rename(resolv_conf, resolv_conf + '.tmp')
-        shutil.copy('/etc/resolv.conf', resolv_conf)
+        # If the tree already has the host's resolv.conf there is nothing
+        # to do (and nothing gets copied up into the overlay).
+        swap_resolv_conf = not (
+            os.path.isfile(resolv_conf) and not os.path.islink(resolv_conf)
+            and filecmp.cmp('/etc/resolv.conf', resolv_conf, shallow=False))
+        if swap_resolv_conf:
+            os.rename(resolv_conf, resolv_conf + '.tmp')
+            shutil.copy('/etc/resolv.conf', resolv_conf)
 
         def _pre_repack():
             for mnt in reversed(mnts):
                 self.umount(mnt.p())
-            os.rename(resolv_conf + '.tmp', resolv_conf)
+            if swap_resolv_conf:
+                os.rename(resolv_conf + '.tmp', resolv_conf)
 
         self.add_pre_repack_hook(_pre_repack)
 
@@ -207,40 +326,158 @@ class EditContext:
 
         lowerdir = lowerdir_for(lowers)
         options = f'lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}'
+        mnt = None
+        if self._overlay_volatile is not False:
+            # Everything in an upperdir is scratch, so there is no point
+            # in the overlay honouring fsync (which dpkg does a lot of).
+            # volatile needs Linux 5.10 or later, so fall back if the
+            # mount fails.
+            try:
+                mnt = self.add_mount(
+                    'overlay', 'overlay', mountpoint,
+                    options=options + ',volatile')
+            except subprocess.CalledProcessError:
+                self._overlay_volatile = False
+            else:
+                self._overlay_volatile = True
+        if mnt is None:
+            mnt = self.add_mount(
+                'overlay', 'overlay', mountpoint, options=options)
         return OverlayMountpoint(
             lowers=lowers,
-            mountpoint=self.add_mount(
-                'overlay', 'overlay', mountpoint, options=options).p(),
+            mountpoint=mnt.p(),
             upperdir=upperdir)
 
     def add_pre_repack_hook(self, hook):
         self._pre_repack_hooks.append(hook)
 
+    def _mount_squash_fuse(self, squash, target):
+        # squashfuse_ll skips libfuse's high-level inode layer and is a
+        # lot faster than plain squashfuse, so prefer it.
+        for tool in 'squashfuse_ll', 'squashfuse':
+            if shutil.which(tool):
+                break
+        else:
+            return None
+        os.makedirs(target, exist_ok=True)
+        self.run_capture([tool, squash, target])
+        self._mounts.append(target)
+        return Mountpoint(device=squash, mountpoint=target)
+
     def mount_squash(self, name):
         target = self.p('old/' + name)
         squash = self.p(f'old/iso/casper/{name}.squashfs')
         if name in self._squash_mounts:
             return self._squash_mounts[name]
+        try:
+            m = self.add_mount('squashfs', squash, target, options='ro')
+        except subprocess.CalledProcessError:
+            # The kernel driver is much faster, but if it is not
+            # usable (e.g. in some containers) try squashfuse.
+            m = self._mount_squash_fuse(squash, target)
+            if m is None:
+                raise
+        self._squash_mounts[name] = m
+        return m
+
+    def mount_squashes(self, names):
+        # Each mount is an independent mount(8) call, so do them
+        # concurrently.
+        todo = {name for name in names if name not in self._squash_mounts}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(self.mount_squash, todo))
+        return [self._squash_mounts[name] for name in names]
+
+    def get_squash_compression(self):
+        if self._squash_compression is None:
+            self._squash_compression = 'gzip'
+            paths = sorted(glob.glob(self.p('old/iso/casper/*.squashfs')))
+            if paths:
+                cp = self.run_capture(['unsquashfs', '-s', paths[0]])
+                for line in cp.stdout.splitlines():
+                    if line.startswith('Compression '):
+                        self._squash_compression = line.split()[1]
+                        break
+        return self._squash_compression
+
+    def mksquashfs(self, src, dest):
+        if self._squash_jobs is not None:
+            # Called from a repack hook: build it along with the others
+            # once all the hooks have run.
+            self._squash_jobs.append((src, dest))
+            return
+        self._mksquashfs(src, dest, os.cpu_count())
+
+    def _mksquashfs(self, src, dest, processors, mem=None):
+        if self.fast_squashfs:
+            comp = ['-comp', 'zstd', '-Xcompression-level', '1']
         else:
-            self._squash_mounts[name] = m = self.add_mount(
-                'squashfs', squash, target, options='ro')
-            return m
+            # Use the same compressor as the squashfses on the source
+            # image so whatever boots it can read the new ones too.
+            comp = ['-comp', self.get_squash_compression()]
+        # Several of these can run at once, so log plain lines rather
+        # than using logged(), whose indentation is shared.
+        name = os.path.basename(dest)
+        self.log(f"building squashfs {name} from {src}")
+        cmd = ['mksquashfs', src, dest] + comp + [
+            '-processors', str(processors)]
+        if mem is not None:
+            cmd.extend(['-mem', f'{mem}M'])
+        self.run(cmd)
+        self.log(f"building squashfs {name} done")
+
+    def _run_squash_jobs(self, jobs):
+        if not jobs:
+            return
+        # Each layer is an independent job on a separate upperdir, so
+        # build them all at once and split the CPUs between them.
+        if not self.fast_squashfs:
+            self.get_squash_compression()
+        processors = max(1, os.cpu_count() // len(jobs))
+        mem = None
+        if len(jobs) > 1:
+            # Left alone, each mksquashfs sizes its caches to a quarter
+            # of physical memory, so several at once can exhaust it.
+            # Share that quarter out between them instead.
+            total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            mem = max(256, total // 4 // len(jobs) // (1024 * 1024))
+        with self.logged(f"building {len(jobs)} squashfs(es)"):
+            with concurrent.futures.ThreadPoolExecutor(len(jobs)) as pool:
+                futures = [
+                    pool.submit(
+                        self._mksquashfs, src, dest, processors, mem)
+                    for src, dest in jobs
+                    ]
+                for f in futures:
+                    f.result()
 
     def get_arch(self):
-        # Is this really the best way??
-        with open(self.p('new/iso/.disk/info')) as fp:
-            return fp.read().strip().split()[-2]
+        if self._arch is None:
+            # Is this really the best way??
+            with open(self.p('new/iso/.disk/info')) as fp:
+                self._arch = fp.read().strip().split()[-2]
+        return self._arch
 
     def get_suite(self):
-        from deb822 import Deb822
-        paths = glob.glob(self.p('old/iso/dists/*/Release'))
-        with open(paths[0]) as fp:
-            release = Deb822(fp)
-        return release['Suite']
+        if self._suite is None:
+            paths = glob.glob(self.p('old/iso/dists/*/Release'))
+            # Suite comes near the top, well before the big checksum
+            # fields, so there is no need to parse the whole file.
+            with open(paths[0]) as fp:
+                for line in fp:
+                    key, sep, value = line.partition(':')
+                    if sep and key == 'Suite':
+                        self._suite = value.strip()
+                        break
+                else:
+                    raise Exception(f"no Suite field in {paths[0]}")
+        return self._suite
 
     def edit_squashfs(self, name, *, add_sys_mounts=True):
         if name and name.endswith('.squashfs'):
             name = name[:-len('.squashfs')]
+        if name in self._edited_squashes:
+            return self._edited_squashes[name]
         lower = self.mount_squash(name)
         reltarget = f'new/{name}'
         target = self.p(reltarget)
@@ -259,30 +496,71 @@ class EditContext:
             if overlay.unchanged():
                 self.log(f"no changes found in squashfs {name!r}")
                 return
-            with self.logged(f"repacking squashfs {name!r}"):
-                os.unlink(new_squash)
-            self.run(['mksquashfs', target, new_squash])
+            os.unlink(new_squash)
+            self.mksquashfs(target, new_squash)
 
         self.add_pre_repack_hook(_pre_repack)
 
         if add_sys_mounts:
             self.add_sys_mounts(target)
 
+        self._edited_squashes[name] = target
         return target
 
     def teardown(self):
-        for mount in reversed(self._mounts):
+        os.close(self._tmp_fd)
+        # umount -R takes care of everything mounted below a mountpoint
+        # (e.g. the sys mounts in a chroot), so only the outermost mounts
+        # need to be named, and umount can be given all of them at once.
+        mounts = list(reversed(self._mounts))
+        outer = [
+            mount for mount in mounts
+            if not any(mount.startswith(other + '/') for other in mounts)
+            ]
+        for mount in outer:
             self.run(['mount', '--make-rprivate', mount])
-            try:
-                self.run(['umount', '-R', mount])
-            except subprocess.CalledProcessError:
-                self.run(['umount', '-l', mount])
-        shutil.rmtree(self.dir)
-        for loop in reversed(self._loops):
-            self.run(['losetup', '--detach', loop])
+        if outer:
+            cp = self.run(['umount', '-R'] + outer, check=False)
+            if cp.returncode != 0:
+                for mount in mounts:
+                    if os.path.ismount(mount):
+                        self.run(['umount', '-l', mount])
+        if self.tmpfs:
+            # Unmounting the tmpfs threw away everything in it.
+            os.rmdir(self.dir)
+        else:
+            # rm walks the (possibly very large) tree a lot faster than
+            # shutil.rmtree can.
+            self.run(['rm', '-rf', '--', self.dir])
+        if self._loops:
+            self.run(['losetup', '--detach'] + list(reversed(self._loops)))
+
+    def probe_fstypes(self, devs):
+        # One blkid call reads the superblocks of all the devices, which
+        # is a lot cheaper than trying to mount each of them.
+        try:
+            cp = self.run_capture(
+                ['blkid', '-o', 'export', '-p'] + devs, check=False)
+        except OSError:
+            return {}
+        fstypes = {}
+        dev = None
+        for line in cp.stdout.splitlines():
+            key, _, value = line.partition('=')
+            if key == 'DEVNAME':
+                dev = value
+            elif key == 'TYPE' and dev is not None:
+                fstypes[dev] = value
+        return fstypes
 
     def find_livefs(self, device):
-        for dev in glob.glob(f'{device}*'):
+        devs = glob.glob(f'{device}*')
+        fstypes = self.probe_fstypes(devs)
+        if fstypes:
+            # Only probe-mount devices that have a filesystem at all,
+            # trying ISO9660 ones first.
+            devs = sorted(fstypes, key=lambda d: fstypes[d] != 'iso9660')
+        for dev in devs:
             try:
                 try_mount = self.add_mount(None, dev, None, options='ro')
             except subprocess.CalledProcessError:
@@ -308,9 +586,12 @@ class EditContext:
             source_mount, self.p('new/iso'))
 
     def repack(self, destpath):
+        self._squash_jobs = []
         with self.logged("running repack hooks"):
             for hook in reversed(self._pre_repack_hooks):
                 hook()
+            jobs, self._squash_jobs = self._squash_jobs, None
+            self._run_squash_jobs(jobs)
         if self._source_overlay.unchanged():
             self.log("no changes!")
             return False
@@ -336,11 +617,21 @@ class EditContext:
 
     def repack_generic(self, destpath):
         with self.logged(f"copying {self.source_path} to {destpath}"):
-            self.run(['cp', self.source_path, destpath])
+            # A reflink makes this nearly free on btrfs/XFS.
+            self.run([
+                'cp', '--reflink=auto', '--sparse=always',
+                self.source_path, destpath,
+                ])
         destloop = self.add_loop(destpath)
         dest_dev = self.find_livefs(destloop)
         dest_mount = self.add_mount(None, dest_dev, None)
         with self.logged("copying live filesystem"):
+            # The copy already has everything that has not changed, so
+            # only transfer what is in the overlay's upperdir.
+            changed = '\0'.join(self._source_overlay.changed_paths())
             self.run(
-                ['rsync', '-axXvHAS', self.p('new/iso/'), '.'],
-                cwd=dest_mount.p())
+                [
+                    'rsync', '-axXvHAS', '--inplace', '--no-whole-file',
+                    '--from0', '--files-from=-', self.p('new/iso/'), '.',
+                ],
+                cwd=dest_mount.p(), input=changed.encode())